@@ -1,6 +1,6 @@
 import os
 import json
-import requests
+from contextlib import contextmanager
 from datetime import datetime
 from dotenv import load_dotenv
 from google.cloud import storage
@@ -14,14 +14,25 @@ from dagster import (
     AssetKey,
     Config,
     Definitions,
+    MetadataValue,
     define_asset_job,
     ScheduleDefinition
 )
 from dagster_gcp import BigQueryResource, GCSResource
 from dagster_dbt import DbtCliResource, dbt_assets, DagsterDbtTranslator
 
+from gcs_to_bq.compaction import compact_parquet_history
 from gcs_to_bq.gcs_handler import load_gcs_to_bq
-from gcs_to_bq.json_to_parquet import convert_json_to_parquet
+from gcs_to_bq.history import delta_blob_name, history_root, resolve_history_uris, write_delta
+from gcs_to_bq.json_to_parquet import (
+    CountBuffer,
+    convert_json_to_parquet,
+    is_file_already_processed,
+    mark_file_as_processed,
+)
+from ingestion.categories import CATEGORY_FILTERS
+from ingestion.hedging import DeadlineExceeded, HedgedPoster
+from pipeline_profiling import profile_stage
 
 
 class CustomDagsterDbtTranslator(DagsterDbtTranslator):
@@ -46,6 +57,49 @@ class MapsConfig(Config):
     bq_dataset: str = os.getenv("BQ_DATASET", "maps_data")
     bq_table: str = os.getenv("BQ_TABLE", "raw_maps_data")
     maps_api_key: str = os.getenv("GOOGLE_MAPS_API_KEY", "")
+    # "json" uploads the daily JSON drop, "parquet" writes the rows straight into the parquet history
+    ingestion_format: str = os.getenv("INGESTION_FORMAT", "json")
+    # Archive the raw API payloads alongside direct-to-Parquet ingestion
+    archive_raw_responses: bool = os.getenv("ARCHIVE_RAW_RESPONSES", "false").lower() == "true"
+    # Target size of compacted history files
+    compaction_target_file_mb: int = int(os.getenv("COMPACTION_TARGET_FILE_MB", "128"))
+    # Per-request timeout, hedge threshold and overall ingestion deadline (0 disables the deadline)
+    request_timeout_s: float = float(os.getenv("REQUEST_TIMEOUT_S", "10"))
+    hedge_percentile: float = float(os.getenv("HEDGE_PERCENTILE", "95"))
+    ingestion_deadline_s: float = float(os.getenv("INGESTION_DEADLINE_S", "0"))
+    # Write CPU/memory profiles of each stage to <profile_dir>/<run_id>/
+    profile: bool = os.getenv("PIPELINE_PROFILE", "false").lower() == "true"
+    profile_dir: str = os.getenv("PIPELINE_PROFILE_DIR", os.path.join(".dagster", "profiles"))
+
+
+@contextmanager
+def profiled(context: AssetExecutionContext, config: MapsConfig, stage: str):
+    """Profile the enclosed block when config.profile is set and link the artifacts in the asset metadata"""
+    if not config.profile:
+        yield
+        return
+    
+    output_dir = os.path.join(config.profile_dir, context.run_id)
+    with profile_stage(stage, output_dir) as profile:
+        yield
+    
+    context.log.info(
+        f"Profiled {stage}: {profile.wall_time:.2f}s wall, {profile.thread_cpu_time:.2f}s CPU, "
+        f"peak memory {profile.peak_memory / 1024 / 1024:.1f} MiB"
+    )
+    metadata = {
+        "profile_wall_time_s": round(profile.wall_time, 3),
+        "profile_thread_cpu_time_s": round(profile.thread_cpu_time, 3),
+        "profile_process_cpu_time_s": round(profile.process_cpu_time, 3),
+        "profile_wall_samples": profile.wall_samples,
+        "profile_peak_memory_mib": round(profile.peak_memory / 1024 / 1024, 2),
+        "profile_summary": MetadataValue.path(profile.artifacts["summary"]),
+        "profile_wall_stacks": MetadataValue.path(profile.artifacts["wall_stacks"]),
+    }
+    if profile.cpu_sampling:
+        metadata["profile_cpu_samples"] = profile.cpu_samples
+        metadata["profile_cpu_stacks"] = MetadataValue.path(profile.artifacts["cpu_stacks"])
+    context.add_output_metadata(metadata)
 
 
 @asset(
@@ -57,6 +111,20 @@ def maps_api_ingestion(context: AssetExecutionContext, config: MapsConfig) -> st
     try:
         if not config.maps_api_key:
             raise ValueError("GOOGLE_MAPS_API_KEY not found in environment variables")
+        if config.ingestion_format not in ("json", "parquet"):
+            raise ValueError(f"Unknown ingestion_format '{config.ingestion_format}', expected 'json' or 'parquet'")
+        
+        client = storage.Client(project=config.gcp_project)
+        bucket = client.bucket(config.gcs_bucket)
+        date_str = datetime.now().strftime('%Y-%m-%d')
+        
+        # Direct-to-Parquet runs are keyed on the run date, like the JSON path's processed marker
+        direct_run_key = f"direct_parquet/{date_str}"
+        direct_delta_key = f"direct-{date_str}"
+        if config.ingestion_format == "parquet" and is_file_already_processed(bucket, direct_run_key):
+            parquet_path = f"gs://{config.gcs_bucket}/{delta_blob_name(config.parquet_output_path, direct_delta_key)}"
+            context.log.info(f"Direct-to-Parquet ingestion for {date_str} already appended, skipping")
+            return parquet_path
         
         # Load place IDs
         place_ids_path = os.path.join(os.path.dirname(__file__), 'ingestion', 'place_ids.json')
@@ -94,51 +162,86 @@ def maps_api_ingestion(context: AssetExecutionContext, config: MapsConfig) -> st
                 "filter": filter_config
             }
 
-            resp = requests.post(
+            return poster.post(
                 endpoint,
                 params={"key": config.maps_api_key},
                 headers=headers,
-                json=body,
-                timeout=10
+                json=body
             )
-            resp.raise_for_status()
-            return resp.json()
+        
+        poster = HedgedPoster(
+            timeout=config.request_timeout_s,
+            deadline_s=config.ingestion_deadline_s or None,
+            hedge_percentile=config.hedge_percentile
+        )
         
         # Fetch data for all cities
         results = {}
+        incomplete_cities = {}
+        buffer = CountBuffer(ingestion_timestamp=datetime.now())
         for city, place_id in place_ids.items():
             context.log.info(f"Processing {city}...")
             city_results = {}
             
             try:
-                context.log.info(f"  Fetching cafes for {city}...")
-                cafe_result = get_place_count(place_id, "cafe")
-                city_results["cafes"] = cafe_result
-                
-                context.log.info(f"  Fetching excellent cafes for {city}...")
-                excellent_cafe_result = get_place_count(place_id, "cafe", 4.5)
-                city_results["excellent_cafes"] = excellent_cafe_result
-                
-                context.log.info(f"  Fetching restaurants for {city}...")
-                restaurant_result = get_place_count(place_id, "restaurant")
-                city_results["restaurants"] = restaurant_result
-                
-                context.log.info(f"  Fetching excellent restaurants for {city}...")
-                excellent_restaurant_result = get_place_count(place_id, "restaurant", 4.5)
-                city_results["excellent_restaurants"] = excellent_restaurant_result
+                for category, (place_type, min_rating) in CATEGORY_FILTERS.items():
+                    context.log.info(f"  Fetching {category.replace('_', ' ')} for {city}...")
+                    try:
+                        city_results[category] = get_place_count(place_id, place_type, min_rating)
+                    except DeadlineExceeded as e:
+                        # Recorded as missing, responses without a count are skipped downstream
+                        context.log.warning(f"  ✗ {category} for {city} missing: {e}")
+                        city_results[category] = {"missing": str(e)}
                 
                 results[city] = city_results
-                context.log.info(f"✓ {city} completed")
             except Exception as e:
                 context.log.error(f"✗ {city} failed: {e}")
                 results[city] = {"error": str(e)}
+                continue
+            
+            missing = [category for category, response in city_results.items() if "missing" in response]
+            if missing:
+                incomplete_cities[city] = missing
+                context.log.warning(f"✗ {city} incomplete, {len(missing)} of {len(CATEGORY_FILTERS)} queries missing at deadline")
+            else:
+                context.log.info(f"✓ {city} completed")
+            
+            if config.ingestion_format == "parquet":
+                for category, api_response in city_results.items():
+                    buffer.record(city, category, api_response)
         
-        # Upload to GCS with date-based folder structure
-        client = storage.Client(project=config.gcp_project)
-        bucket = client.bucket(config.gcs_bucket)
+        poster.close()
+        request_stats = poster.stats()
+        context.log.info(f"Request stats: {request_stats}")
+        completed_cities = len([r for r in results.values() if 'error' not in r]) - len(incomplete_cities)
+        missing_queries = sum(len(missing) for missing in incomplete_cities.values())
+        if incomplete_cities:
+            context.log.warning(f"Missing at deadline: {missing_queries} queries in {incomplete_cities}")
+        context.add_output_metadata({
+            **{f"request_{key}": value for key, value in request_stats.items() if value is not None},
+            "completed_cities": completed_cities,
+            "failed_cities": len([r for r in results.values() if 'error' in r]),
+            "missing_queries": missing_queries,
+            "incomplete_cities": MetadataValue.json(incomplete_cities),
+        })
         
-        # Use date-based path structure matching current pattern
-        date_str = datetime.now().strftime('%Y-%m-%d')
+        if config.ingestion_format == "parquet":
+            if config.archive_raw_responses:
+                # Kept outside maps_data/ so the JSON converter never picks it up
+                raw_blob = bucket.blob(f"raw/{date_str}/maps_api_responses.json")
+                raw_blob.upload_from_string(json.dumps(results), content_type='application/json')
+                context.log.info(f"✓ Archived raw responses to gs://{config.gcs_bucket}/{raw_blob.name}")
+            
+            if len(buffer) == 0:
+                raise ValueError("No valid records recorded from the Maps API")
+            
+            parquet_path = write_delta(bucket, config.parquet_output_path, direct_delta_key, buffer.to_table())
+            mark_file_as_processed(bucket, direct_run_key)
+            context.log.info(f"✓ Wrote {len(buffer)} records to {parquet_path}")
+            context.log.info(f"Processed {completed_cities} cities successfully")
+            return parquet_path
+        
+        # Upload to GCS with date-based folder structure matching current pattern
         blob_name = f"maps_data/{date_str}/maps_data.json"
         
         blob = bucket.blob(blob_name)
@@ -146,7 +249,7 @@ def maps_api_ingestion(context: AssetExecutionContext, config: MapsConfig) -> st
         
         gcs_path = f"gs://{config.gcs_bucket}/{blob_name}"
         context.log.info(f"✓ Uploaded Maps data to {gcs_path}")
-        context.log.info(f"Processed {len([r for r in results.values() if 'error' not in r])} cities successfully")
+        context.log.info(f"Processed {completed_cities} cities successfully")
         
         return gcs_path
         
@@ -163,21 +266,28 @@ def maps_api_ingestion(context: AssetExecutionContext, config: MapsConfig) -> st
 def json_to_parquet_conversion(context: AssetExecutionContext, config: MapsConfig) -> str:
     """Convert latest Maps JSON data from GCS to Parquet format (incremental processing)"""
     try:
+        if config.ingestion_format == "parquet":
+            # Ingestion already wrote its rows into the parquet history
+            parquet_path = f"gs://{config.gcs_bucket}/{history_root(config.parquet_output_path)}"
+            context.log.info(f"Direct-to-Parquet ingestion, nothing to convert: {parquet_path}")
+            return parquet_path
+        
         context.log.info(f"Processing latest JSON file with prefix: {config.json_path_pattern}")
         
-        parquet_path = convert_json_to_parquet(
-            gcs_bucket=config.gcs_bucket,
-            json_path_pattern=config.json_path_pattern,
-            parquet_output_path=config.parquet_output_path,
-            project_id=config.gcp_project
-        )
+        with profiled(context, config, "json_to_parquet_conversion"):
+            parquet_path = convert_json_to_parquet(
+                gcs_bucket=config.gcs_bucket,
+                json_path_pattern=config.json_path_pattern,
+                parquet_output_path=config.parquet_output_path,
+                project_id=config.gcp_project
+            )
         
         if parquet_path:
             context.log.info(f"Successfully processed latest JSON file to: {parquet_path}")
             return parquet_path
         else:
-            # Return existing parquet path even if no new files processed
-            existing_path = f"gs://{config.gcs_bucket}/{config.parquet_output_path}"
+            # Return the parquet history even if no new files processed
+            existing_path = f"gs://{config.gcs_bucket}/{history_root(config.parquet_output_path)}"
             context.log.info(f"No new files to process, returning existing path: {existing_path}")
             return existing_path
             
@@ -186,22 +296,58 @@ def json_to_parquet_conversion(context: AssetExecutionContext, config: MapsConfi
         raise
 
 
+@asset(
+    description="Compact Parquet history into sorted, size-targeted files",
+    deps=[json_to_parquet_conversion],
+    group_name="preprocessing"
+)
+def compacted_maps_history(context: AssetExecutionContext, config: MapsConfig) -> str:
+    """Rewrite the accumulated Parquet history sorted by city, place_type and ingestion_timestamp"""
+    try:
+        compacted_path = compact_parquet_history(
+            gcs_bucket=config.gcs_bucket,
+            parquet_output_path=config.parquet_output_path,
+            project_id=config.gcp_project,
+            target_file_mb=config.compaction_target_file_mb
+        )
+        
+        if not compacted_path:
+            # No history yet (fresh deployment) or another compaction is running
+            history_path = f"gs://{config.gcs_bucket}/{history_root(config.parquet_output_path)}"
+            context.log.info(f"Nothing compacted, returning history root: {history_path}")
+            return history_path
+        
+        context.log.info(f"Compacted history available at: {compacted_path}")
+        return compacted_path
+        
+    except Exception as e:
+        context.log.error(f"Failed to compact Parquet history: {str(e)}")
+        raise
+
+
 @asset(
     description="Load Maps data from GCS to BigQuery",
     deps=[json_to_parquet_conversion],
     group_name="warehouse"
 )
 def bq_maps_data(context: AssetExecutionContext, config: MapsConfig, json_to_parquet_conversion: str) -> str:
-    """Load converted Parquet data from GCS to BigQuery"""
+    """Load the Parquet history (compacted generation plus new deltas) from GCS to BigQuery"""
     try:
-        context.log.info(f"Loading data from Parquet file: {json_to_parquet_conversion}")
+        context.log.info(f"Latest Parquet output: {json_to_parquet_conversion}")
         
-        load_gcs_to_bq(
-            gcs_path=json_to_parquet_conversion,
-            project_id=config.gcp_project,
-            dataset_id=config.bq_dataset,
-            table_id=config.bq_table
-        )
+        bucket = storage.Client(project=config.gcp_project).bucket(config.gcs_bucket)
+        history_uris = resolve_history_uris(bucket, config.parquet_output_path)
+        if not history_uris:
+            raise ValueError(f"No Parquet history under gs://{config.gcs_bucket}/{history_root(config.parquet_output_path)}")
+        context.log.info(f"Loading {len(history_uris)} Parquet files")
+        
+        with profiled(context, config, "bq_maps_data"):
+            load_gcs_to_bq(
+                gcs_path=history_uris,
+                project_id=config.gcp_project,
+                dataset_id=config.bq_dataset,
+                table_id=config.bq_table
+            )
         
         table_id = f"{config.gcp_project}.{config.bq_dataset}.{config.bq_table}"
         context.log.info(f"Loaded data to BigQuery table: {table_id}")
@@ -237,7 +383,7 @@ def export_dashboard_data(context: AssetExecutionContext, config: MapsConfig, bi
     """Export dashboard_metrics table from BigQuery to local Parquet file for Evidence"""
     try:
         # Use injected BigQuery resource
-        with bigquery.get_client() as client:
+        with bigquery.get_client() as client, profiled(context, config, "export_dashboard_data"):
             # Query to get dashboard metrics
             query = f"""
             SELECT 
@@ -327,6 +473,14 @@ maps_pipeline_job = define_asset_job(
     config={"execution": {"config": {"in_process": {}}}}
 )
 
+# Background compaction, kept out of the daily critical path
+compaction_job = define_asset_job(
+    name="parquet_compaction",
+    selection=[compacted_maps_history],
+    description="Compact accumulated Parquet history for predicate pushdown",
+    config={"execution": {"config": {"in_process": {}}}}
+)
+
 # Define schedule (daily at 6 AM)
 maps_pipeline_schedule = ScheduleDefinition(
     job=maps_pipeline_job,
@@ -334,11 +488,17 @@ maps_pipeline_schedule = ScheduleDefinition(
     name="daily_maps_pipeline"
 )
 
+compaction_schedule = ScheduleDefinition(
+    job=compaction_job,
+    cron_schedule="0 3 * * 0",  # Weekly, Sunday at 3 AM
+    name="weekly_parquet_compaction"
+)
+
 # Resources
 defs = Definitions(
-    assets=[maps_api_ingestion, json_to_parquet_conversion, bq_maps_data, maps_dbt_assets, export_dashboard_data, evidence_dashboard],
-    jobs=[maps_pipeline_job],
-    schedules=[maps_pipeline_schedule],
+    assets=[maps_api_ingestion, json_to_parquet_conversion, compacted_maps_history, bq_maps_data, maps_dbt_assets, export_dashboard_data, evidence_dashboard],
+    jobs=[maps_pipeline_job, compaction_job],
+    schedules=[maps_pipeline_schedule, compaction_schedule],
     resources={
         "gcs": GCSResource(project=os.getenv("GCP_PROJECT", "your-project-id")),
         "bigquery": BigQueryResource(project=os.getenv("GCP_PROJECT", "your-project-id")),
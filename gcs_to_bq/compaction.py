@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+import posixpath
+import tempfile
+import time
+from typing import Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound, PreconditionFailed
+from google.cloud import storage
+from loguru import logger
+
+from gcs_to_bq.history import (
+    compacted_prefix,
+    folded_blob_names,
+    live_deltas,
+    manifest_blob_name,
+    read_manifest,
+    read_parquet_blob,
+)
+
+
+SORT_KEYS = [
+    ("city", "ascending"),
+    ("place_type", "ascending"),
+    ("ingestion_timestamp", "ascending"),
+]
+DEFAULT_TARGET_FILE_MB = 128
+DEFAULT_ROW_GROUP_ROWS = 64 * 1024
+LEASE_SECONDS = 60 * 60
+
+
+def acquire_lease(bucket: storage.Bucket, prefix: str) -> Optional[storage.Blob]:
+    """
+    Take the compaction lease, an object created with a generation precondition
+
+    An expired lease (a compaction that crashed) is broken and taken over.
+
+    Returns:
+        The lease blob, or None if another compaction holds it
+    """
+    lease = bucket.blob(posixpath.join(prefix, "_lease"))
+    for _ in range(2):
+        try:
+            lease.upload_from_string(
+                json.dumps({"expires_at": time.time() + LEASE_SECONDS}),
+                content_type='application/json',
+                if_generation_match=0
+            )
+            return lease
+        except PreconditionFailed:
+            holder = bucket.get_blob(lease.name)
+            if holder is None:
+                continue
+            if json.loads(holder.download_as_text())["expires_at"] > time.time():
+                return None
+            logger.warning("Breaking expired compaction lease")
+            delete_blob(bucket, holder.name, holder.generation)
+    return None
+
+
+def holds_lease(bucket: storage.Bucket, lease: storage.Blob) -> bool:
+    current = bucket.get_blob(lease.name)
+    return current is not None and current.generation == lease.generation
+
+
+def delete_blob(bucket: storage.Bucket, blob_name: str, generation: Optional[int] = None) -> None:
+    """Delete a blob (only if it is still at the given generation), ignoring ones already gone"""
+    try:
+        bucket.blob(blob_name).delete(if_generation_match=generation)
+    except (NotFound, PreconditionFailed):
+        pass
+
+
+def compact_parquet_history(
+    gcs_bucket: str,
+    parquet_output_path: str,
+    project_id: str,
+    target_file_mb: int = DEFAULT_TARGET_FILE_MB,
+    row_group_rows: int = DEFAULT_ROW_GROUP_ROWS
+) -> Optional[str]:
+    """
+    Fold the delta files of the parquet history into a new compacted generation
+
+    The current generation and all live deltas are rewritten sorted by city,
+    place_type and ingestion_timestamp, into size-targeted files with
+    row-group statistics, so readers can prune by city or date range. Only
+    the holder of the compaction lease compacts. The manifest is swapped
+    with a generation precondition once every file is uploaded; readers
+    going through gcs_to_bq.history.resolve_history_uris therefore always
+    see a complete history. Re-running without new deltas is a no-op.
+
+    Args:
+        gcs_bucket: GCS bucket name
+        parquet_output_path: Configured parquet output path, the root of the history
+        project_id: GCP project ID
+        target_file_mb: Target (uncompressed) size of each output file
+        row_group_rows: Maximum number of rows per row group
+
+    Returns:
+        GCS glob of the current compacted files, or None if nothing was compacted
+    """
+    try:
+        client = storage.Client(project=project_id)
+        bucket = client.bucket(gcs_bucket)
+        prefix = compacted_prefix(parquet_output_path)
+
+        lease = acquire_lease(bucket, prefix)
+        if lease is None:
+            logger.info("Another compaction holds the lease, skipping")
+            return None
+
+        files = []
+        published = False
+        try:
+            manifest, manifest_blob = read_manifest(bucket, parquet_output_path)
+            deltas = live_deltas(bucket, parquet_output_path, manifest)
+            if not deltas:
+                if manifest is None:
+                    logger.warning(f"No parquet history under gs://{gcs_bucket}/{prefix}, nothing to compact")
+                    return None
+                logger.info(f"No new deltas since generation {manifest['generation']}, skipping")
+                return f"gs://{gcs_bucket}/{manifest['directory']}/*.parquet"
+
+            tables = [read_parquet_blob(bucket, name) for name in (manifest["files"] if manifest else [])]
+            tables += [read_parquet_blob(bucket, blob.name, blob.generation) for blob in deltas]
+            table = pa.concat_tables(tables).sort_by(SORT_KEYS)
+
+            bytes_per_row = max(1, table.nbytes // max(1, table.num_rows))
+            rows_per_file = max(1, target_file_mb * 1024 * 1024 // bytes_per_row)
+            logger.info(f"Compacting {table.num_rows} rows from {len(deltas)} deltas into files of up to {rows_per_file} rows")
+
+            # The lease generation keeps the directory unique even against a compaction whose lease expired
+            number = manifest["generation"] + 1 if manifest else 1
+            directory = posixpath.join(prefix, f"gen-{number:06d}-{lease.generation}")
+            for part, offset in enumerate(range(0, max(1, table.num_rows), rows_per_file)):
+                blob_name = posixpath.join(directory, f"part-{part:05d}.parquet")
+                with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as tmp_file:
+                    pq.write_table(
+                        table.slice(offset, rows_per_file),
+                        tmp_file.name,
+                        row_group_size=row_group_rows,
+                        write_statistics=True
+                    )
+                    bucket.blob(blob_name).upload_from_filename(tmp_file.name)
+                    os.unlink(tmp_file.name)
+                files.append(blob_name)
+
+            missing = [name for name in files if not bucket.blob(name).exists()]
+            if missing:
+                raise RuntimeError(f"Compacted files disappeared before publishing: {missing}")
+            if not holds_lease(bucket, lease):
+                raise RuntimeError(f"Compaction lease was lost, not publishing {directory}")
+
+            new_manifest = {
+                "generation": number,
+                "directory": directory,
+                "files": files,
+                "rows": table.num_rows,
+                "sort_keys": [key for key, _ in SORT_KEYS],
+                "consumed": {blob.name: blob.generation for blob in deltas},
+                "folded": sorted((folded_blob_names(manifest) if manifest else set()) | {blob.name for blob in deltas}),
+                "previously_consumed": manifest["consumed"] if manifest else {},
+                "previous_directory": manifest["directory"] if manifest else None,
+            }
+
+            try:
+                bucket.blob(manifest_blob_name(parquet_output_path)).upload_from_string(
+                    json.dumps(new_manifest, indent=2),
+                    content_type='application/json',
+                    if_generation_match=manifest_blob.generation if manifest_blob else 0
+                )
+            except PreconditionFailed:
+                raise RuntimeError(f"Manifest changed while holding the compaction lease, not publishing {directory}")
+            published = True
+
+            # Readers of the replaced manifest still need its files and the deltas it did not fold in;
+            # only what manifests older than that one referenced can go
+            if manifest:
+                if manifest["previous_directory"]:
+                    for blob in bucket.list_blobs(prefix=manifest["previous_directory"] + "/"):
+                        delete_blob(bucket, blob.name, blob.generation)
+                for name, generation in manifest["previously_consumed"].items():
+                    delete_blob(bucket, name, generation)
+
+            output_glob = f"gs://{gcs_bucket}/{directory}/*.parquet"
+            logger.info(f"Compacted {table.num_rows} rows into {len(files)} files at {output_glob}")
+            return output_glob
+
+        finally:
+            if not published:
+                # Nothing references an unpublished generation
+                for name in files:
+                    delete_blob(bucket, name)
+            delete_blob(bucket, lease.name, lease.generation)
+
+    except Exception as e:
+        logger.error(f"Failed to compact parquet history: {e}")
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact the accumulated parquet history in GCS")
+    parser.add_argument("--bucket", default=os.getenv("GCS_BUCKET_NAME"), help="GCS bucket name")
+    parser.add_argument("--path", default=os.getenv("PARQUET_OUTPUT_PATH", "processed/maps_data.parquet"),
+                        help="Configured parquet output path, the root of the history")
+    parser.add_argument("--project", default=os.getenv("GCP_PROJECT_ID"), help="GCP project ID")
+    parser.add_argument("--target-file-mb", type=int, default=DEFAULT_TARGET_FILE_MB)
+    parser.add_argument("--row-group-rows", type=int, default=DEFAULT_ROW_GROUP_ROWS)
+    args = parser.parse_args()
+    if not args.bucket or not args.project:
+        parser.error("--bucket and --project are required (or GCS_BUCKET_NAME / GCP_PROJECT_ID)")
+
+    compact_parquet_history(args.bucket, args.path, args.project, args.target_file_mb, args.row_group_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,11 @@
+from typing import List, Union
+
 from google.cloud import bigquery
 from loguru import logger
 
 
-def load_gcs_to_bq(gcs_path: str, project_id: str, dataset_id: str, table_id: str) -> None:
-    """Load data from GCS to BigQuery"""
+def load_gcs_to_bq(gcs_path: Union[str, List[str]], project_id: str, dataset_id: str, table_id: str) -> None:
+    """Load data from GCS to BigQuery (a single URI, wildcard or list of URIs)"""
     try:
         client = bigquery.Client(project=project_id)
         
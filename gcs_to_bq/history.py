@@ -0,0 +1,165 @@
+"""
+Layout of the processed parquet history in GCS
+
+For parquet_output_path = processed/maps_data.parquet:
+
+    processed/maps_data/delta/<key>.parquet               rows added by one ingestion run
+    processed/maps_data/compacted/gen-<n>-<id>/*.parquet  sorted, size-targeted history
+    processed/maps_data/compacted/_manifest.json          current compacted generation
+
+The history is the files of the current generation plus every delta that
+generation has not folded in yet. Deltas are write-once: a key that already
+exists, or that a compaction has folded in, is never written again, so a
+retried run cannot add its rows twice. Every manifest lists the blob names
+of all deltas ever folded in ("folded"), and readers skip those names even
+after compaction deletes them. "consumed" (and "previously_consumed" for
+the generation before) records the GCS generation of the deltas each
+compaction folded in, for deleting exactly those objects later. A parquet
+file left at parquet_output_path by older versions is treated as a delta.
+"""
+
+import json
+import os
+import posixpath
+import tempfile
+from typing import List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage
+from loguru import logger
+
+
+# Normalized schema of the processed parquet history
+PARQUET_SCHEMA = pa.schema([
+    ("ingestion_timestamp", pa.timestamp("ns")),
+    ("city", pa.string()),
+    ("place_type", pa.string()),
+    ("rating_filter", pa.float64()),
+    ("count", pa.int64()),
+])
+
+
+def history_root(parquet_output_path: str) -> str:
+    """processed/maps_data.parquet -> processed/maps_data"""
+    return posixpath.splitext(parquet_output_path)[0]
+
+
+def compacted_prefix(parquet_output_path: str) -> str:
+    return posixpath.join(history_root(parquet_output_path), "compacted")
+
+
+def delta_blob_name(parquet_output_path: str, key: str) -> str:
+    return posixpath.join(history_root(parquet_output_path), "delta", f"{key}.parquet")
+
+
+def manifest_blob_name(parquet_output_path: str) -> str:
+    return posixpath.join(compacted_prefix(parquet_output_path), "_manifest.json")
+
+
+def write_delta(bucket: storage.Bucket, parquet_output_path: str, key: str, table: pa.Table) -> str:
+    """
+    Add rows to the parquet history as a delta file
+
+    Deltas are write-once: if the key was already written, or already folded
+    into the compacted history, the existing rows are kept and nothing is
+    written. A key derived from the run (its date or source file) therefore
+    makes retries idempotent.
+
+    Args:
+        bucket: GCS bucket object
+        parquet_output_path: Configured parquet output path, the root of the history
+        key: Unique name of the delta
+        table: Rows to add, in PARQUET_SCHEMA
+
+    Returns:
+        GCS path to the delta file
+    """
+    blob_name = delta_blob_name(parquet_output_path, key)
+    delta_path = f"gs://{bucket.name}/{blob_name}"
+
+    manifest, _ = read_manifest(bucket, parquet_output_path)
+    if manifest and blob_name in folded_blob_names(manifest):
+        logger.info(f"Delta {delta_path} was already compacted, not writing it again")
+        return delta_path
+
+    with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as tmp_file:
+        pq.write_table(table.cast(PARQUET_SCHEMA), tmp_file.name)
+        try:
+            bucket.blob(blob_name).upload_from_filename(tmp_file.name, if_generation_match=0)
+        except PreconditionFailed:
+            logger.info(f"Delta {delta_path} already exists, keeping it")
+            return delta_path
+        finally:
+            os.unlink(tmp_file.name)
+
+    logger.info(f"Wrote {table.num_rows} records to {delta_path}")
+    return delta_path
+
+
+def read_parquet_blob(bucket: storage.Bucket, blob_name: str, generation: Optional[int] = None) -> pa.Table:
+    """Download a parquet file of the history (optionally a pinned generation) in PARQUET_SCHEMA"""
+    with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as tmp_file:
+        bucket.blob(blob_name, generation=generation).download_to_filename(tmp_file.name)
+        table = pq.read_table(tmp_file.name)
+        os.unlink(tmp_file.name)
+    return table.select(PARQUET_SCHEMA.names).cast(PARQUET_SCHEMA)
+
+
+def read_manifest(bucket: storage.Bucket, parquet_output_path: str) -> Tuple[Optional[dict], Optional[storage.Blob]]:
+    """
+    Read the manifest of the current compacted generation
+
+    Returns:
+        (manifest, manifest blob), or (None, None) if history was never compacted
+    """
+    blob = bucket.get_blob(manifest_blob_name(parquet_output_path))
+    if blob is None:
+        return None, None
+    # Read the generation we got metadata for, the manifest may be swapped meanwhile
+    content = bucket.blob(blob.name, generation=blob.generation).download_as_text()
+    return json.loads(content), blob
+
+
+def folded_blob_names(manifest: dict) -> Set[str]:
+    """Names of every delta (and legacy file) folded into the compacted history so far"""
+    return set(manifest.get("folded", [])) | set(manifest.get("previously_consumed", {})) | set(manifest["consumed"])
+
+
+def live_deltas(bucket: storage.Bucket, parquet_output_path: str, manifest: Optional[dict]) -> List[storage.Blob]:
+    """Delta files (and a legacy monolithic file) not folded into the manifest's generation"""
+    folded = folded_blob_names(manifest) if manifest else set()
+    consumed = {**manifest.get("previously_consumed", {}), **manifest["consumed"]} if manifest else {}
+
+    candidates = list(bucket.list_blobs(prefix=posixpath.join(history_root(parquet_output_path), "delta") + "/"))
+    legacy = bucket.get_blob(parquet_output_path)
+    if legacy is not None:
+        candidates.append(legacy)
+
+    deltas = []
+    for blob in candidates:
+        if not blob.name.endswith('.parquet'):
+            continue
+        if blob.name in folded:
+            if consumed.get(blob.name) != blob.generation:
+                # Rewritten after it was folded in (e.g. by an older writer), its rows are already in the history
+                logger.warning(f"Ignoring gs://{bucket.name}/{blob.name}, it was already folded into the compacted history")
+            continue
+        deltas.append(blob)
+    return deltas
+
+
+def resolve_history_uris(bucket: storage.Bucket, parquet_output_path: str) -> List[str]:
+    """
+    List the GCS URIs that make up the parquet history
+
+    The manifest is read before the deltas are listed; compaction keeps the
+    files of the previous generation and the deltas it folded in until the
+    next compaction, so the returned set stays complete and free of
+    duplicates while a compaction swaps the manifest.
+    """
+    manifest, _ = read_manifest(bucket, parquet_output_path)
+    blob_names = list(manifest["files"]) if manifest else []
+    blob_names += [blob.name for blob in live_deltas(bucket, parquet_output_path, manifest)]
+    return [f"gs://{bucket.name}/{name}" for name in blob_names]
@@ -2,10 +2,88 @@ import pandas as pd
 from google.cloud import storage
 from loguru import logger
 import json
-import tempfile
-import os
+from datetime import datetime
 from typing import Optional
 
+import pyarrow as pa
+
+from gcs_to_bq.history import PARQUET_SCHEMA, delta_blob_name, write_delta
+from ingestion.categories import CATEGORY_FILTERS
+
+
+def extract_count(api_response) -> Optional[int]:
+    """Extract the venue count from an INSIGHT_COUNT response (structure may vary)"""
+    if not isinstance(api_response, dict):
+        return None
+    
+    # Try direct count field first (current structure)
+    if 'count' in api_response:
+        count = api_response['count']
+    # Try insights structure (alternative structure)
+    elif 'insights' in api_response:
+        insights = api_response['insights']
+        if not (isinstance(insights, list) and len(insights) > 0 and 'count' in insights[0]):
+            return None
+        count = insights[0]['count']
+    else:
+        return None
+    
+    if isinstance(count, str):
+        try:
+            count = int(count)
+        except ValueError:
+            return None
+    return count
+
+
+class CountBuffer:
+    """
+    Columnar buffer of normalized count rows, filled as API responses arrive
+    
+    Rows share a single ingestion timestamp and are kept column by column so
+    the buffer can be turned into an Arrow table without an intermediate
+    list of dicts.
+    """
+    
+    def __init__(self, ingestion_timestamp: datetime):
+        self.ingestion_timestamp = ingestion_timestamp
+        self.cities: list = []
+        self.place_types: list = []
+        self.rating_filters: list = []
+        self.counts: list = []
+    
+    def __len__(self) -> int:
+        return len(self.counts)
+    
+    def record(self, city: str, category: str, api_response) -> bool:
+        """Record one API response, returns False if it holds no usable count"""
+        if category not in CATEGORY_FILTERS:
+            return False
+        count = extract_count(api_response)
+        if count is None:
+            return False
+        place_type, rating_filter = CATEGORY_FILTERS[category]
+        self.cities.append(city)
+        self.place_types.append(place_type)
+        self.rating_filters.append(rating_filter)
+        self.counts.append(count)
+        return True
+    
+    def to_table(self) -> pa.Table:
+        timestamps = pa.array([self.ingestion_timestamp] * len(self), type=pa.timestamp("ns"))
+        return pa.Table.from_arrays([
+            timestamps,
+            pa.array(self.cities, type=pa.string()),
+            pa.array(self.place_types, type=pa.string()),
+            pa.array(self.rating_filters, type=pa.float64()),
+            pa.array(self.counts, type=pa.int64()),
+        ], schema=PARQUET_SCHEMA)
+
+
+def json_delta_key(json_blob_name: str) -> str:
+    """maps_data/2025-08-02/maps_data.json -> json-maps_data_2025-08-02_maps_data"""
+    return "json-" + json_blob_name.removesuffix('.json').replace('/', '_')
+
 
 def get_latest_json_file(bucket: storage.Bucket, prefix: str = "") -> Optional[storage.Blob]:
     """
@@ -78,11 +156,11 @@ def convert_json_to_parquet(
     Args:
         gcs_bucket: GCS bucket name
         json_path_pattern: Pattern for JSON files (e.g., "maps_data/*/*.json") - used for prefix
-        parquet_output_path: Output path for parquet file in GCS
+        parquet_output_path: Configured parquet output path, the root of the parquet history
         project_id: GCP project ID
         
     Returns:
-        GCS path to the created parquet file
+        GCS path to the delta file holding the JSON file's rows
     """
     try:
         client = storage.Client(project=project_id)
@@ -110,8 +188,8 @@ def convert_json_to_parquet(
         # Check if this file was already processed
         if is_file_already_processed(bucket, latest_json_file.name):
             logger.info(f"File {latest_json_file.name} already processed, skipping")
-            # Return existing parquet path
-            return f"gs://{gcs_bucket}/{parquet_output_path}"
+            # Return the delta written when it was processed
+            return f"gs://{gcs_bucket}/{delta_blob_name(parquet_output_path, json_delta_key(latest_json_file.name))}"
             
         logger.info(f"Processing new file: {latest_json_file.name}")
         
@@ -133,43 +211,11 @@ def convert_json_to_parquet(
                     # Process each place type (cafes, restaurants, etc.)
                     for category, api_response in city_data.items():
                         # Extract place_type and rating_filter from category name
-                        if category == "cafes":
-                            place_type = "cafe"
-                            rating_filter = None
-                        elif category == "excellent_cafes":
-                            place_type = "cafe" 
-                            rating_filter = 4.5
-                        elif category == "restaurants":
-                            place_type = "restaurant"
-                            rating_filter = None
-                        elif category == "excellent_restaurants":
-                            place_type = "restaurant"
-                            rating_filter = 4.5
-                        else:
+                        if category not in CATEGORY_FILTERS:
                             continue  # Skip unknown categories
+                        place_type, rating_filter = CATEGORY_FILTERS[category]
                         
-                        # Extract count from API response (structure may vary)
-                        count = None
-                        if isinstance(api_response, dict):
-                            # Try direct count field first (current structure)
-                            if 'count' in api_response:
-                                count = api_response['count']
-                                if isinstance(count, str):
-                                    try:
-                                        count = int(count)
-                                    except ValueError:
-                                        count = None
-                            # Try insights structure (alternative structure)
-                            elif 'insights' in api_response:
-                                insights = api_response['insights']
-                                if isinstance(insights, list) and len(insights) > 0:
-                                    if 'count' in insights[0]:
-                                        count = insights[0]['count']
-                                        if isinstance(count, str):
-                                            try:
-                                                count = int(count)
-                                            except ValueError:
-                                                count = None
+                        count = extract_count(api_response)
                         
                         # Only add record if we successfully extracted a count
                         if count is not None:
@@ -200,32 +246,14 @@ def convert_json_to_parquet(
         new_df['ingestion_timestamp'] = pd.to_datetime(new_df['ingestion_timestamp'])
         new_df['count'] = pd.to_numeric(new_df['count'], errors='coerce')
         
-        # Append to existing parquet or create new one
-        output_blob = bucket.blob(parquet_output_path)
-        
-        # Load existing data if it exists
-        existing_df = None
-        if output_blob.exists():
-            with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as existing_tmp:
-                output_blob.download_to_filename(existing_tmp.name)
-                existing_df = pd.read_parquet(existing_tmp.name)
-                os.unlink(existing_tmp.name)
-        
-        # Combine data
-        final_df = pd.concat([existing_df, new_df], ignore_index=True) if existing_df is not None else new_df
-        logger.info(f"Writing {len(final_df)} total records to parquet")
-        
-        # Write parquet file
-        with tempfile.NamedTemporaryFile(suffix='.parquet', delete=False) as tmp_file:
-            final_df.to_parquet(tmp_file.name, index=False)
-            output_blob.upload_from_filename(tmp_file.name)
-            os.unlink(tmp_file.name)
+        # Add the rows to the parquet history as a delta of this JSON file
+        new_table = pa.Table.from_pandas(new_df, schema=PARQUET_SCHEMA, preserve_index=False)
+        output_gcs_path = write_delta(bucket, parquet_output_path, json_delta_key(latest_json_file.name), new_table)
         
         # Mark the file as processed
         mark_file_as_processed(bucket, latest_json_file.name)
         
-        output_gcs_path = f"gs://{gcs_bucket}/{parquet_output_path}"
-        logger.info(f"Successfully processed {latest_json_file.name} and updated {output_gcs_path}")
+        logger.info(f"Successfully processed {latest_json_file.name} into {output_gcs_path}")
         
         return output_gcs_path
         
@@ -0,0 +1,14 @@
+"""
+Ingestion categories
+
+Maps each category key of the daily JSON drop to the Area Insights query it
+comes from, (place_type, min_rating), which is also the (place_type,
+rating_filter) pair of the normalized parquet schema.
+"""
+
+CATEGORY_FILTERS = {
+    "cafes": ("cafe", None),
+    "excellent_cafes": ("cafe", 4.5),
+    "restaurants": ("restaurant", None),
+    "excellent_restaurants": ("restaurant", 4.5),
+}
@@ -0,0 +1,137 @@
+"""
+Hedged HTTP requests with per-request timeouts and an overall run deadline
+
+Once enough latencies have been observed, a request that is still running
+after the configured latency percentile (p95 by default) gets a duplicate
+"hedge" request; whichever successful response arrives first wins. Every
+request is also bounded by the time left until the run deadline, after
+which DeadlineExceeded is raised instead of issuing new requests.
+"""
+
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the run deadline passes before a response arrived"""
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[rank]
+
+
+class HedgedPoster:
+    def __init__(self, timeout=10, deadline_s=None, hedge_percentile=95,
+                 min_samples=5, min_hedge_delay=0.1, window=200, max_workers=8):
+        """
+        Args:
+            timeout: Per-request timeout in seconds
+            deadline_s: Seconds from now after which the run stops issuing requests (None for no deadline)
+            hedge_percentile: Observed latency percentile after which a hedge is sent
+            min_samples: Latencies to observe before hedging starts
+            min_hedge_delay: Lower bound of the hedge delay in seconds
+            window: Number of recent latencies the percentile is computed over
+            max_workers: Threads available for in-flight primary and hedge requests
+        """
+        self.timeout = timeout
+        self.deadline = time.monotonic() + deadline_s if deadline_s else None
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.min_hedge_delay = min_hedge_delay
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_misses = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedged-post")
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def hedge_delay(self):
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return max(self.min_hedge_delay, percentile(list(self.latencies), self.hedge_percentile))
+
+    def _send(self, url, timeout, kwargs):
+        start = time.monotonic()
+        resp = requests.post(url, timeout=timeout, **kwargs)
+        resp.raise_for_status()
+        with self._lock:
+            self.latencies.append(time.monotonic() - start)
+        return resp.json()
+
+    def post(self, url, **kwargs):
+        """POST url and return the decoded JSON of the first successful response"""
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            self.deadline_misses += 1
+            raise DeadlineExceeded("run deadline exceeded before request was sent")
+
+        timeout = self.timeout if remaining is None else min(self.timeout, remaining)
+        self.requests += 1
+        primary = self._executor.submit(self._send, url, timeout, kwargs)
+        pending = {primary}
+
+        delay = self.hedge_delay()
+        if delay is not None and delay < timeout:
+            done, _ = wait(pending, timeout=delay)
+            if not done:
+                self.hedges += 1
+                pending.add(self._executor.submit(self._send, url, timeout - delay, kwargs))
+
+        # Requests time out on their own, the margin only covers scheduling
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=timeout + 1, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        self.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            self.deadline_misses += 1
+            raise DeadlineExceeded(f"run deadline exceeded while waiting for response: {error}")
+        raise error or requests.Timeout(f"no response within {timeout:.1f}s")
+
+    def stats(self):
+        """Hedging and latency figures for tuning"""
+        with self._lock:
+            latencies = list(self.latencies)
+
+        def rounded(value):
+            return round(value, 3) if value is not None else None
+
+        return {
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_rate": round(self.hedges / self.requests, 3) if self.requests else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "deadline_misses": self.deadline_misses,
+            "latency_p50_s": rounded(percentile(latencies, 50)),
+            "latency_p95_s": rounded(percentile(latencies, 95)),
+            "latency_p99_s": rounded(percentile(latencies, 99)),
+        }
+
+    def close(self):
+        # Losing requests are left to finish in the background
+        self._executor.shutdown(wait=False, cancel_futures=True)
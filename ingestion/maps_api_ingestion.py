@@ -7,19 +7,35 @@ and uploads to Google Cloud Storage for further processing.
 
 Usage:
     python maps_api_ingestion.py [CITY_KEY]
+    python maps_api_ingestion.py --shard i/N [--date YYYY-MM-DD]
+    python maps_api_ingestion.py merge --shards N [--date YYYY-MM-DD]
     
 If CITY_KEY is provided, only processes that city.
 If not provided, processes all cities in place_ids.json.
+
+With --shard i/N (0 <= i < N), only the place IDs whose stable hash falls
+into shard i are processed, and the results are written as a partial drop
+under maps_data/<date>/shards/. Once all N shards have finished, the merge
+subcommand combines them into the canonical maps_data/<date>/maps_data.json.
 """
 
 import sys
 import json
-import requests
+import hashlib
+import argparse
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 from google.cloud import storage
 
+try:
+    from ingestion.categories import CATEGORY_FILTERS
+    from ingestion.hedging import DeadlineExceeded, HedgedPoster
+except ImportError:
+    # Run as a script from inside ingestion/, where the package itself is not importable
+    from categories import CATEGORY_FILTERS
+    from hedging import DeadlineExceeded, HedgedPoster
+
 load_dotenv()
 
 ENDPOINT = "https://areainsights.googleapis.com/v1:computeInsights"
@@ -28,12 +44,35 @@ HEADERS = {
     "X-Goog-FieldMask": "*"
 }
 
+DAILY_PREFIX = "maps_data"
+
 def load_place_ids():
     place_ids_path = os.path.join(os.path.dirname(__file__), 'place_ids.json')
     with open(place_ids_path, 'r') as f:
         return json.load(f)
 
-def get_place_count(api_key, place_id, place_type, min_rating=None):
+def parse_shard(value):
+    """Parse an "i/N" shard spec into (index, total)"""
+    try:
+        index, total = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected i/N")
+    if total < 1 or not 0 <= index < total:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected 0 <= i < N")
+    return index, total
+
+def shard_for(place_id, total):
+    """Stable shard assignment of a place ID (independent of PYTHONHASHSEED)"""
+    digest = hashlib.sha1(place_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % total
+
+def shard_blob_name(date_str, index, total):
+    return f"{DAILY_PREFIX}/{date_str}/shards/maps_data.shard-{index}-of-{total}.json"
+
+def daily_blob_name(date_str):
+    return f"{DAILY_PREFIX}/{date_str}/maps_data.json"
+
+def get_place_count(poster, api_key, place_id, place_type, min_rating=None):
     filter_config = {
         "locationFilter": {
             "region": {
@@ -55,22 +94,34 @@ def get_place_count(api_key, place_id, place_type, min_rating=None):
         "filter": filter_config
     }
 
-    resp = requests.post(
+    return poster.post(
         ENDPOINT,
         params={"key": api_key},
         headers=HEADERS,
-        json=body,
-        timeout=10
+        json=body
     )
-    resp.raise_for_status()
-    return resp.json()
 
-def upload_to_gcs(results, bucket_name, project_id):
+def fetch_city(poster, api_key, city, place_id):
+    city_results = {}
+    
+    for category, (place_type, min_rating) in CATEGORY_FILTERS.items():
+        print(f"  Fetching {category.replace('_', ' ')} for {city}...")
+        try:
+            city_results[category] = get_place_count(poster, api_key, place_id, place_type, min_rating)
+        except DeadlineExceeded as e:
+            # Recorded as missing, the converter skips responses without a count
+            print(f"  ✗ {category} for {city} missing: {e}")
+            city_results[category] = {"missing": str(e)}
+    
+    return city_results
+
+def upload_to_gcs(results, bucket_name, project_id, blob_name=None):
     client = storage.Client(project=project_id)
     bucket = client.bucket(bucket_name)
     
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    blob_name = f"cafe_restaurant_data_{timestamp}.json"
+    if blob_name is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        blob_name = f"cafe_restaurant_data_{timestamp}.json"
     
     blob = bucket.blob(blob_name)
     blob.upload_from_string(json.dumps(results, indent=2), content_type='application/json')
@@ -78,13 +129,80 @@ def upload_to_gcs(results, bucket_name, project_id):
     print(f"✓ Uploaded to gs://{bucket_name}/{blob_name}")
     return blob_name
 
+def merge_shards(bucket_name, project_id, date_str, total):
+    """
+    Combine the partial drops of all shards for a day into the canonical daily JSON.
+    
+    Cities are written in place_ids.json order (unknown cities after, sorted by
+    name) so the output is identical regardless of which shard finished first.
+    """
+    client = storage.Client(project=project_id)
+    bucket = client.bucket(bucket_name)
+    
+    results = {}
+    missing = []
+    for index in range(total):
+        blob = bucket.blob(shard_blob_name(date_str, index, total))
+        if not blob.exists():
+            missing.append(index)
+            continue
+        shard_results = json.loads(blob.download_as_text())
+        overlap = results.keys() & shard_results.keys()
+        if overlap:
+            sys.exit(f"Error: cities {sorted(overlap)} appear in more than one shard")
+        results.update(shard_results)
+        print(f"✓ Loaded shard {index}/{total} ({len(shard_results)} cities)")
+    
+    if missing:
+        sys.exit(f"Error: missing shard outputs {missing} of {total} for {date_str}")
+    
+    order = list(load_place_ids())
+    ordered = {city: results[city] for city in order if city in results}
+    ordered.update((city, results[city]) for city in sorted(results.keys() - set(order)))
+    
+    return upload_to_gcs(ordered, bucket_name, project_id, daily_blob_name(date_str))
+
+def parse_args(argv):
+    if argv and argv[0] == "merge":
+        parser = argparse.ArgumentParser(prog="maps_api_ingestion.py merge",
+                                         description="Merge shard outputs into the daily JSON")
+        parser.add_argument("--shards", type=int, required=True, help="Total number of shards (N)")
+        parser.add_argument("--date", default=datetime.now().strftime('%Y-%m-%d'),
+                            help="Drop date (YYYY-MM-DD), defaults to today")
+        args = parser.parse_args(argv[1:])
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        args.command = "merge"
+        return args
+    
+    parser = argparse.ArgumentParser(prog="maps_api_ingestion.py",
+                                     description="Fetch venue counts and upload them to GCS")
+    parser.add_argument("city_key", nargs="?", metavar="CITY_KEY", help="Only process this city")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="Only process place IDs hashed into shard i of N")
+    parser.add_argument("--date", default=datetime.now().strftime('%Y-%m-%d'),
+                        help="Drop date for shard outputs (YYYY-MM-DD), defaults to today")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="Per-request timeout in seconds")
+    parser.add_argument("--deadline", type=float, default=None,
+                        help="Overall run deadline in seconds, queries still unfinished are recorded as missing")
+    parser.add_argument("--hedge-percentile", type=float, default=95,
+                        help="Send a duplicate request once a query runs longer than this latency percentile")
+    args = parser.parse_args(argv)
+    if args.city_key and args.shard:
+        parser.error("CITY_KEY and --shard are mutually exclusive")
+    args.command = "ingest"
+    return args
+
 def main():
+    args = parse_args(sys.argv[1:])
+    
     api_key = os.getenv('GOOGLE_MAPS_API_KEY')
     bucket_name = os.getenv('GCS_BUCKET_NAME')
     project_id = os.getenv('GCP_PROJECT_ID')
     credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
     
-    if not api_key:
+    if not api_key and args.command == "ingest":
         sys.exit("Error: GOOGLE_MAPS_API_KEY not found in .env file")
     if not bucket_name:
         sys.exit("Error: GCS_BUCKET_NAME not found in .env file")
@@ -97,7 +215,11 @@ def main():
     credentials_path = os.path.expanduser(credentials_path)
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
     
-    city_key = sys.argv[1] if len(sys.argv) > 1 else None
+    if args.command == "merge":
+        merge_shards(bucket_name, project_id, args.date, args.shards)
+        return
+    
+    city_key = args.city_key
     
     place_ids = load_place_ids()
     results = {}
@@ -106,40 +228,52 @@ def main():
         if city_key not in place_ids:
             sys.exit(f"City '{city_key}' not found in place_ids.json")
         cities_to_process = {city_key: place_ids[city_key]}
+    elif args.shard:
+        index, total = args.shard
+        cities_to_process = {
+            city: place_id for city, place_id in place_ids.items()
+            if shard_for(place_id, total) == index
+        }
+        print(f"Shard {index}/{total}: {len(cities_to_process)} of {len(place_ids)} cities")
     else:
         cities_to_process = place_ids
     
+    poster = HedgedPoster(timeout=args.timeout, deadline_s=args.deadline,
+                          hedge_percentile=args.hedge_percentile)
+    incomplete_cities = {}
     for city, place_id in cities_to_process.items():
         print(f"Processing {city}...")
-        city_results = {}
         
         try:
-            print(f"  Fetching cafes for {city}...")
-            cafe_result = get_place_count(api_key, place_id, "cafe")
-            city_results["cafes"] = cafe_result
-            
-            print(f"  Fetching excellent cafes for {city}...")
-            excellent_cafe_result = get_place_count(api_key, place_id, "cafe", 4.5)
-            city_results["excellent_cafes"] = excellent_cafe_result
-            
-            print(f"  Fetching restaurants for {city}...")
-            restaurant_result = get_place_count(api_key, place_id, "restaurant")
-            city_results["restaurants"] = restaurant_result
-            
-            print(f"  Fetching excellent restaurants for {city}...")
-            excellent_restaurant_result = get_place_count(api_key, place_id, "restaurant", 4.5)
-            city_results["excellent_restaurants"] = excellent_restaurant_result
-            
-            results[city] = city_results
-            print(f"✓ {city} completed")
+            results[city] = fetch_city(poster, api_key, city, place_id)
         except Exception as e:
             print(f"✗ {city} failed: {e}")
             results[city] = {"error": str(e)}
+            continue
+        
+        missing = [category for category, response in results[city].items() if "missing" in response]
+        if missing:
+            incomplete_cities[city] = missing
+            print(f"✗ {city} incomplete, {len(missing)} of {len(CATEGORY_FILTERS)} queries missing at deadline")
+        else:
+            print(f"✓ {city} completed")
+    poster.close()
+    
+    completed = len([r for r in results.values() if "error" not in r]) - len(incomplete_cities)
+    print(f"Completed {completed} of {len(cities_to_process)} cities")
+    if incomplete_cities:
+        missing_queries = sum(len(missing) for missing in incomplete_cities.values())
+        print(f"Missing at deadline: {missing_queries} queries in {json.dumps(incomplete_cities)}")
+    print(f"Request stats: {json.dumps(poster.stats())}")
     
+    blob_name = shard_blob_name(args.date, *args.shard) if args.shard else None
     try:
-        upload_to_gcs(results, bucket_name, project_id)
+        upload_to_gcs(results, bucket_name, project_id, blob_name)
     except Exception as e:
         print(f"✗ Failed to upload to GCS: {e}")
+        if args.shard:
+            # A missing partial drop must fail the matrix job so merge is not run on a gap
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
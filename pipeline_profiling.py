@@ -0,0 +1,198 @@
+"""
+Opt-in CPU and memory profiling for pipeline stages
+
+Wraps a block of code in a sampling profiler (a background thread that
+periodically records the stack of the profiled thread) and tracemalloc.
+Every sample counts towards the wall-clock profile; where the platform
+exposes per-thread CPU clocks, samples taken while the profiled thread
+consumed CPU since the previous tick also count towards the CPU profile,
+so time spent blocked on GCS or BigQuery does not show up as CPU.
+Each profiled stage writes three artifacts:
+
+- <stage>.cpu.collapsed.txt / <stage>.wall.collapsed.txt: folded stacks
+  ("frame;frame;frame count"), ready for flamegraph.pl, speedscope or inferno
+- <stage>.profile.txt: wall and CPU time, hottest functions, memory peak
+  and top allocation sites
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+
+DEFAULT_INTERVAL = 0.005
+TOP_N = 20
+
+
+class StackSampler:
+    """Sample the stack of one thread at a fixed interval, split into wall-clock and on-CPU samples"""
+
+    def __init__(self, thread_id: int, interval: float = DEFAULT_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.wall_stacks: Counter = Counter()
+        self.cpu_stacks: Counter = Counter()
+        try:
+            self.cpu_clock = time.pthread_getcpuclockid(thread_id)
+        except (AttributeError, OSError):
+            # No per-thread CPU clock (e.g. Windows), only the wall-clock profile is available
+            self.cpu_clock = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label.replace(";", ":")
+
+    def _cpu_time(self) -> float:
+        return time.clock_gettime(self.cpu_clock) if self.cpu_clock is not None else 0.0
+
+    def _run(self) -> None:
+        last_cpu = self._cpu_time()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_label(frame))
+                frame = frame.f_back
+            cpu = self._cpu_time()
+            on_cpu = cpu > last_cpu
+            last_cpu = cpu
+            if stack:
+                key = ";".join(reversed(stack))
+                self.wall_stacks[key] += 1
+                if on_cpu:
+                    self.cpu_stacks[key] += 1
+
+
+class StageProfile:
+    """Results of a profiled stage, filled in when the block exits"""
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.wall_time: float = 0.0
+        self.thread_cpu_time: float = 0.0
+        self.process_cpu_time: float = 0.0
+        self.wall_samples: int = 0
+        self.cpu_samples: int = 0
+        self.cpu_sampling: bool = False
+        self.peak_memory: int = 0
+        self.artifacts: Dict[str, str] = {}
+
+
+def _top_functions(stacks: Counter):
+    self_samples: Counter = Counter()
+    total_samples: Counter = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        self_samples[frames[-1]] += count
+        for frame in set(frames):
+            total_samples[frame] += count
+    return self_samples, total_samples
+
+
+def _write_summary(path: str, profile: StageProfile, sampler: StackSampler,
+                   snapshot: Optional[tracemalloc.Snapshot]) -> None:
+    lines = [
+        f"Stage: {profile.stage}",
+        f"Wall time: {profile.wall_time:.3f}s",
+        f"CPU time: {profile.thread_cpu_time:.3f}s (profiled thread), {profile.process_cpu_time:.3f}s (process)",
+        f"Wall-clock samples: {profile.wall_samples} (every {sampler.interval * 1000:.1f}ms)",
+        f"On-CPU samples: {profile.cpu_samples}" if profile.cpu_sampling
+        else "On-CPU samples: unavailable (no per-thread CPU clock on this platform)",
+        f"Peak traced memory: {profile.peak_memory / 1024 / 1024:.2f} MiB",
+    ]
+
+    sections = [("on-CPU", sampler.cpu_stacks)] if profile.cpu_sampling else []
+    sections.append(("wall-clock", sampler.wall_stacks))
+    for label, stacks in sections:
+        self_samples, total_samples = _top_functions(stacks)
+        lines += ["", f"Top {TOP_N} functions by {label} self samples:"]
+        lines += [f"  {count:8d}  {frame}" for frame, count in self_samples.most_common(TOP_N)]
+        lines += ["", f"Top {TOP_N} functions by {label} inclusive samples:"]
+        lines += [f"  {count:8d}  {frame}" for frame, count in total_samples.most_common(TOP_N)]
+
+    if snapshot is not None:
+        lines += ["", f"Top {TOP_N} allocation sites (live at stage end):"]
+        for stat in snapshot.statistics("lineno")[:TOP_N]:
+            frame = stat.traceback[0]
+            lines.append(f"  {stat.size / 1024:10.1f} KiB  {stat.count:8d} blocks  {frame.filename}:{frame.lineno}")
+
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def _write_collapsed(path: str, stacks: Counter) -> None:
+    with open(path, "w") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+@contextmanager
+def profile_stage(stage: str, output_dir: str, interval: float = DEFAULT_INTERVAL) -> Iterator[StageProfile]:
+    """
+    Profile CPU and memory of the enclosed block
+
+    Args:
+        stage: Stage name, used for the artifact file names
+        output_dir: Directory the artifacts are written to (created if missing)
+        interval: Seconds between stack samples
+
+    Yields:
+        StageProfile whose timings and artifact paths are set on exit
+    """
+    profile = StageProfile(stage)
+    sampler = StackSampler(threading.get_ident(), interval)
+
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    thread_cpu_start = time.thread_time()
+    process_cpu_start = time.process_time()
+    sampler.start()
+    try:
+        yield profile
+    finally:
+        sampler.stop()
+        profile.wall_time = time.perf_counter() - start
+        profile.thread_cpu_time = time.thread_time() - thread_cpu_start
+        profile.process_cpu_time = time.process_time() - process_cpu_start
+        profile.wall_samples = sum(sampler.wall_stacks.values())
+        profile.cpu_samples = sum(sampler.cpu_stacks.values())
+        profile.cpu_sampling = sampler.cpu_clock is not None
+        profile.peak_memory = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        if started_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(output_dir, exist_ok=True)
+        cpu_stacks_path = os.path.join(output_dir, f"{stage}.cpu.collapsed.txt")
+        _write_collapsed(cpu_stacks_path, sampler.cpu_stacks)
+        wall_stacks_path = os.path.join(output_dir, f"{stage}.wall.collapsed.txt")
+        _write_collapsed(wall_stacks_path, sampler.wall_stacks)
+
+        summary_path = os.path.join(output_dir, f"{stage}.profile.txt")
+        _write_summary(summary_path, profile, sampler, snapshot)
+
+        profile.artifacts = {
+            "cpu_stacks": cpu_stacks_path,
+            "wall_stacks": wall_stacks_path,
+            "summary": summary_path,
+        }
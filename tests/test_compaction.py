@@ -0,0 +1,247 @@
+import datetime
+import itertools
+import json
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from gcs_to_bq import compaction
+from gcs_to_bq.compaction import compact_parquet_history
+from gcs_to_bq.history import (
+    PARQUET_SCHEMA,
+    compacted_prefix,
+    delta_blob_name,
+    live_deltas,
+    read_manifest,
+    read_parquet_blob,
+    resolve_history_uris,
+    write_delta,
+)
+
+
+PATH = "processed/maps_data.parquet"
+LEASE = compacted_prefix(PATH) + "/_lease"
+
+
+class FakeBlob:
+    """Just enough of google.cloud.storage.Blob, with object generations and their preconditions"""
+
+    def __init__(self, bucket, name, generation=None):
+        self.bucket = bucket
+        self.name = name
+        self._pinned = generation
+        stored = bucket.objects.get(name)
+        self.generation = generation if generation is not None else (stored[0] if stored else None)
+
+    def _check(self, if_generation_match):
+        current = self.bucket.objects.get(self.name, (0, None))[0]
+        if if_generation_match is not None and current != if_generation_match:
+            raise PreconditionFailed(f"{self.name} is at generation {current}")
+
+    def _put(self, data, if_generation_match):
+        self._check(if_generation_match)
+        self.generation = next(self.bucket.generations)
+        self.bucket.objects[self.name] = (self.generation, data)
+
+    def _get(self):
+        generation, data = self.bucket.objects.get(self.name, (None, None))
+        if generation is None or (self._pinned is not None and generation != self._pinned):
+            raise NotFound(self.name)
+        return data
+
+    def upload_from_string(self, data, content_type=None, if_generation_match=None):
+        self._put(data.encode() if isinstance(data, str) else data, if_generation_match)
+
+    def upload_from_filename(self, filename, if_generation_match=None):
+        with open(filename, "rb") as f:
+            self._put(f.read(), if_generation_match)
+
+    def download_to_filename(self, filename):
+        with open(filename, "wb") as f:
+            f.write(self._get())
+
+    def download_as_text(self):
+        return self._get().decode()
+
+    def exists(self):
+        return self.name in self.bucket.objects
+
+    def delete(self, if_generation_match=None):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        self._check(if_generation_match)
+        del self.bucket.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self, name="bucket"):
+        self.name = name
+        self.objects = {}  # blob name -> (generation, bytes)
+        self.generations = itertools.count(1000)
+
+    def blob(self, name, generation=None):
+        return FakeBlob(self, name, generation)
+
+    def get_blob(self, name):
+        return FakeBlob(self, name) if name in self.objects else None
+
+    def list_blobs(self, prefix=""):
+        return [FakeBlob(self, name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    bucket = FakeBucket()
+
+    class FakeClient:
+        def __init__(self, project=None):
+            pass
+
+        def bucket(self, name):
+            return bucket
+
+    monkeypatch.setattr(compaction.storage, "Client", FakeClient)
+    return bucket
+
+
+def rows(city, day, count=1):
+    return pa.table({
+        "ingestion_timestamp": [datetime.datetime(2025, 1, day)],
+        "city": [city],
+        "place_type": ["cafe"],
+        "rating_filter": [None],
+        "count": [count],
+    }, schema=PARQUET_SCHEMA)
+
+
+def upload_table(bucket, blob_name, table):
+    """Write a file the way an older writer would, without write_delta's checks"""
+    with tempfile.NamedTemporaryFile(suffix=".parquet") as tmp_file:
+        pq.write_table(table, tmp_file.name)
+        bucket.blob(blob_name).upload_from_filename(tmp_file.name)
+
+
+def read_uris(bucket, uris):
+    tables = [read_parquet_blob(bucket, uri.removeprefix(f"gs://{bucket.name}/")) for uri in uris]
+    table = pa.concat_tables(tables) if tables else PARQUET_SCHEMA.empty_table()
+    return sorted(zip(table.column("city").to_pylist(), table.column("count").to_pylist()))
+
+
+def history(bucket):
+    return read_uris(bucket, resolve_history_uris(bucket, PATH))
+
+
+def compact(**kwargs):
+    return compact_parquet_history("bucket", PATH, "project", **kwargs)
+
+
+def test_rerun_without_new_deltas_is_a_no_op(bucket):
+    assert compact() is None
+
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1))
+    output = compact()
+    objects = dict(bucket.objects)
+
+    assert compact() == output
+    assert bucket.objects == objects
+    assert history(bucket) == [("Berlin", 1)]
+
+
+def test_retried_delta_keeps_the_first_write(bucket):
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1, count=1))
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1, count=2))
+
+    assert history(bucket) == [("Berlin", 1)]
+
+
+def test_reader_of_previous_manifest_stays_complete_after_swap(bucket):
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1))
+    write_delta(bucket, PATH, "direct-2025-01-02", rows("London", 2))
+    compact(target_file_mb=0)
+    write_delta(bucket, PATH, "direct-2025-01-03", rows("Helsinki", 3))
+
+    previous, _ = read_manifest(bucket, PATH)
+    compact(target_file_mb=0)
+    current, _ = read_manifest(bucket, PATH)
+    assert current["directory"] != previous["directory"]
+
+    names = previous["files"] + [blob.name for blob in live_deltas(bucket, PATH, previous)]
+    expected = [("Berlin", 1), ("Helsinki", 1), ("London", 1)]
+    assert read_uris(bucket, [f"gs://bucket/{name}" for name in names]) == expected
+    assert history(bucket) == expected
+
+
+def test_lease_contention_returns_none(bucket):
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1))
+    bucket.blob(LEASE).upload_from_string(json.dumps({"expires_at": 4102444800}), if_generation_match=0)
+
+    assert compact() is None
+    assert read_manifest(bucket, PATH) == (None, None)
+    assert LEASE in bucket.objects
+
+
+def test_expired_lease_is_broken_and_taken_over(bucket):
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1))
+    bucket.blob(LEASE).upload_from_string(json.dumps({"expires_at": 0}), if_generation_match=0)
+
+    assert compact() is not None
+    assert read_manifest(bucket, PATH)[0]["generation"] == 1
+    assert LEASE not in bucket.objects
+
+
+def test_lease_lost_before_publishing_removes_the_generation(bucket, monkeypatch):
+    write_delta(bucket, PATH, "direct-2025-01-01", rows("Berlin", 1))
+    monkeypatch.setattr(compaction, "holds_lease", lambda bucket, lease: False)
+
+    with pytest.raises(RuntimeError, match="lease was lost"):
+        compact()
+
+    assert not [name for name in bucket.objects if "/gen-" in name]
+    assert read_manifest(bucket, PATH) == (None, None)
+    assert history(bucket) == [("Berlin", 1)]
+
+
+def test_legacy_file_is_folded_in_once(bucket):
+    upload_table(bucket, PATH, pa.concat_tables([rows("Amsterdam", 1), rows("Berlin", 1)]))
+    write_delta(bucket, PATH, "direct-2025-01-02", rows("London", 2))
+    expected = [("Amsterdam", 1), ("Berlin", 1), ("London", 1)]
+    assert history(bucket) == expected
+
+    compact()
+    assert history(bucket) == expected
+
+    # Two generations later the legacy file is deleted; an older writer recreating it is ignored
+    for day in (3, 4):
+        write_delta(bucket, PATH, f"direct-2025-01-0{day}", rows("Helsinki", day))
+        compact()
+    expected += [("Helsinki", 1), ("Helsinki", 1)]
+    assert PATH not in bucket.objects
+    assert history(bucket) == sorted(expected)
+
+    upload_table(bucket, PATH, pa.concat_tables([rows("Amsterdam", 1), rows("Berlin", 1), rows("Oslo", 5)]))
+    compact()
+    assert history(bucket) == sorted(expected)
+
+
+def test_rewriting_a_consumed_delta_does_not_duplicate_rows(bucket):
+    key = "json-maps_data_2025-01-01_maps_data"
+    write_delta(bucket, PATH, key, rows("Berlin", 1))
+    compact()
+
+    # A retry after compaction, through write_delta and behind its back
+    write_delta(bucket, PATH, key, rows("Berlin", 1))
+    assert history(bucket) == [("Berlin", 1)]
+    upload_table(bucket, delta_blob_name(PATH, key), rows("Berlin", 1))
+    assert history(bucket) == [("Berlin", 1)]
+    compact()
+    assert history(bucket) == [("Berlin", 1)]
+
+    # Still refused once compaction has deleted the consumed delta
+    for day in (2, 3):
+        write_delta(bucket, PATH, f"direct-2025-01-0{day}", rows("London", day))
+        compact()
+    write_delta(bucket, PATH, key, rows("Berlin", 1))
+    assert history(bucket) == [("Berlin", 1), ("London", 1), ("London", 1)]
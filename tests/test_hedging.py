@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from ingestion import hedging
+from ingestion.hedging import DeadlineExceeded, HedgedPoster, percentile
+
+
+class FakeResponse:
+    def __init__(self, payload, status_error=None):
+        self.payload = payload
+        self.status_error = status_error
+
+    def raise_for_status(self):
+        if self.status_error:
+            raise self.status_error
+
+    def json(self):
+        return self.payload
+
+
+def scripted_post(monkeypatch, delays, errors=None):
+    """Patch requests.post so the n-th call sleeps delays[n] and then returns {"call": n} or raises errors[n]"""
+    errors = errors or {}
+    calls = []
+    lock = threading.Lock()
+
+    def post(url, timeout, **kwargs):
+        with lock:
+            n = len(calls)
+            calls.append(timeout)
+        delay = delays[n] if n < len(delays) else delays[-1]
+        if delay > timeout:
+            time.sleep(timeout)
+            raise requests.Timeout(f"call {n} timed out")
+        time.sleep(delay)
+        if n in errors:
+            return FakeResponse(None, errors[n])
+        return FakeResponse({"call": n})
+
+    monkeypatch.setattr(hedging.requests, "post", post)
+    return calls
+
+
+@pytest.fixture
+def poster():
+    posters = []
+
+    def make(**kwargs):
+        posters.append(HedgedPoster(**kwargs))
+        return posters[-1]
+
+    yield make
+    for p in posters:
+        p.close()
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 31))
+    assert percentile([], 95) is None
+    assert percentile([7], 50) == 7
+    assert percentile(values, 95) == 29
+    assert percentile(values, 100) == 30
+    assert percentile(values, 0) == 1
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile([3, 1, 2, 4], 51) == 3
+
+
+def test_no_hedge_before_min_samples(monkeypatch, poster):
+    scripted_post(monkeypatch, [0.01, 0.01, 0.2])
+    p = poster(timeout=5, min_samples=3, min_hedge_delay=0.01)
+    for _ in range(3):
+        p.post("http://example")
+    assert p.hedges == 0
+    assert p.stats()["requests"] == 3
+
+
+def test_hedge_sent_past_percentile_and_win_counted(monkeypatch, poster):
+    # Two fast calls, then a slow primary (call 2) overtaken by its hedge (call 3)
+    calls = scripted_post(monkeypatch, [0.01, 0.01, 1.0, 0.01])
+    p = poster(timeout=5, min_samples=2, min_hedge_delay=0.05)
+    p.post("http://example")
+    p.post("http://example")
+
+    start = time.monotonic()
+    assert p.post("http://example") == {"call": 3}
+    assert time.monotonic() - start < 0.5
+    assert len(calls) == 4
+    assert p.hedges == 1
+    assert p.hedge_wins == 1
+    assert p.stats()["hedge_rate"] == round(1 / 3, 3)
+
+
+def test_fast_primary_error_raised_without_hedge(monkeypatch, poster):
+    error = requests.HTTPError("500 Server Error")
+    calls = scripted_post(monkeypatch, [0.01, 0.01, 0.01], errors={2: error})
+    p = poster(timeout=5, min_samples=2, min_hedge_delay=0.5)
+    p.post("http://example")
+    p.post("http://example")
+
+    with pytest.raises(requests.HTTPError):
+        p.post("http://example")
+    assert len(calls) == 3
+    assert p.hedges == 0
+
+
+def test_deadline_exceeded_before_sending(monkeypatch, poster):
+    calls = scripted_post(monkeypatch, [0.01])
+    p = poster(timeout=5, deadline_s=0.05)
+    time.sleep(0.1)
+
+    with pytest.raises(DeadlineExceeded):
+        p.post("http://example")
+    assert calls == []
+    assert p.deadline_misses == 1
+
+
+def test_deadline_exceeded_while_waiting(monkeypatch, poster):
+    calls = scripted_post(monkeypatch, [1.0])
+    p = poster(timeout=5, deadline_s=0.2)
+
+    start = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        p.post("http://example")
+    # The request timeout is capped by the time left until the deadline
+    assert calls[0] <= 0.2
+    assert time.monotonic() - start < 1.0
+    assert p.deadline_misses == 1